@@ -7,9 +7,14 @@
 from attrs import define
 import csv
 from typing import Dict, Optional, List, Any
-from functools import cache
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from functools import lru_cache, partial
+from itertools import compress
+from operator import itemgetter
+import io
 import json
-from collections.abc import Hashable
+from pprint import pprint
 import glob
 import os
 
@@ -43,33 +48,28 @@ PATTERN_SOURCE_CODE = '{parent}/{bugtype}/buggy_{idx}.sol'
 
 ################################################################################
 
-def replace_keys(d, replacement, assume_bug_type: Optional[str]=None):
-    '''Replace keys in a dict using the `replacement` mapping'''
-    m = {replacement.get(k, k): v for k, v in d.items()}
-    if assume_bug_type:
-        m[BUGTYPE] = assume_bug_type
-    return m
-
-def replace_vals(d, replacement):
-    '''Replace values in a dict using the `replacement` mapping'''
-    return {k: (replacement.get(v, v) if isinstance(v, Hashable) else v) for k, v in d.items()}
+def map_bugtype_val(v):
+    '''Map a reported value through BUGTYPE_MAPPING, tolerating unhashable values'''
+    try:
+        return BUGTYPE_MAPPING.get(v, v)
+    except TypeError:  # unhashable, e.g. the 'input' list
+        return v
 
 def idx_from_file(filename: str) -> int:
-    return int(filename.split('.')[0].split('_')[-1])
+    # stem is everything before the first dot, e.g. 'buggy_1' in 'buggy_1.sol.result.json'
+    stem = os.path.basename(filename).partition('.')[0]
+    return int(stem.rpartition('_')[-1])
 
-def report_file_by_idx(report_files, idx: int) -> Optional[str]:
-    try:
-        return next(f for f in report_files if f'_{idx}.' in f.split(os.path.sep)[-1])
-    except StopIteration:
-        return None
+def report_files_by_idx(report_files) -> Dict[int, str]:
+    '''Index report files by their contract index for O(1) lookup'''
+    return {idx_from_file(f): f for f in report_files}
 
 def bugtype_from_csv(csv_path: str) -> str:
-    return csv_path.split(os.path.sep)[-2]
+    return os.path.basename(os.path.dirname(csv_path))
 
 def contract_path_from_csv(csv_path: str) -> str:
     idx = idx_from_file(csv_path)
-    path_prefix = os.path.sep.join(csv_path.split(os.path.sep)[:-1])
-    return f'{path_prefix}/buggy_{idx}.sol'
+    return os.path.join(os.path.dirname(csv_path), f'buggy_{idx}.sol')
 
 ################################################################################
 
@@ -95,6 +95,7 @@ class Report():
 ################################################################################
 class InjectedBug():
     '''Inejected bugs by SolidiFI, loaded from a csv file, assuming these bug types are the ground truth'''
+    __slots__ = ('csv_path', 'bug_type', 'bugs', '_line_index')
     csv_path: str
     bug_type: str
     def __init__(self, csv_path: str):
@@ -102,55 +103,63 @@ class InjectedBug():
         self.bug_type = bugtype_from_csv(csv_path)
         bugs = []
         with open(csv_path, 'r') as f:
-            reader = csv.DictReader(f, delimiter=',')
-            # assuing one csv file contains only one bug type, so we don't need to check typo in the csv bug_type column
-            bugs = [replace_keys(line, BUG_KEY_REPLACEMENT, self.bug_type) for line in reader]
-        bugs = sorted(bugs, key=lambda d: d[LINENUM])
+            reader = csv.reader(f, delimiter=',')
+            header = next(reader, None)
+            if header:
+                # Map the header once instead of rebuilding every row dict with
+                # replace_keys; one csv file contains only one bug type, so we
+                # don't need to check typo in the csv bug_type column
+                header = [BUG_KEY_REPLACEMENT.get(h, h) for h in header]
+                bugs = [dict(zip(header, row), **{BUGTYPE: self.bug_type}) for row in reader]
+        for bug in bugs:
+            bug[LINENUM] = int(bug[LINENUM])
+            bug['length'] = int(bug['length'])
+        bugs = sorted(bugs, key=itemgetter(LINENUM))
         self.csv_path = csv_path
         self.bugs = bugs
+        # Precompute a line -> bug index so lookups are O(1) instead of a
+        # linear scan over all injected bugs per reported bug
+        self._line_index = {}
+        for bug in bugs:
+            for ln in range(bug[LINENUM], bug[LINENUM] + bug['length'] + 1):
+                self._line_index.setdefault(ln, bug)
 
-    @cache
-    def bug_by_line(self, linenum: int, candidate_bugs: Optional[List[Dict[str, str]]] = None) -> Optional[Dict[str, str]]:
+    def bug_by_line(self, linenum: int) -> Optional[Dict[str, str]]:
         '''Returns the injected bug type at a line'''
-        bugs = candidate_bugs or self.bugs 
-        for bug in bugs:
-            ln_start = int(bug[LINENUM])
-            ln_end = ln_start + int(bug['length'])
-            if linenum >= ln_start and linenum <= ln_end:
-                return bug
-        return None
+        return self._line_index.get(linenum)
 
     def classify(self, reported_bugs: List[Dict[str, Any]]) -> Report:
         '''Classify a bug reported by tool to FP or NP'''
         # i_bugs = [bug for bug in self.bugs if bug.get(BUGTYPE) == self.bug_type]
-        i_bugs = list(self.bugs) # Each csv in `SolidiFI-benchmarks` contains only one type of bugs. So no need to filter 
+        i_bugs = self.bugs # Each csv in `SolidiFI-benchmarks` contains only one type of bugs. So no need to filter; read-only, so no copy either
         
-        x_fp = []         # detected, but actually these is no bug
-        x_tp = []         # detected the correct type
-        x_miscls = []     # misclassified: detected, but bug type is not correct
-        x_seen_ibugs = [] # found bugs with the correct type
-        for r_bug in reported_bugs:
-            i_bug = self.bug_by_line(r_bug[LINENUM])
-            true_bug_type = i_bug and i_bug.get(BUGTYPE)
-            if true_bug_type:
-                x_seen_ibugs.append(i_bug)
-            if not true_bug_type:
-                if r_bug[BUGTYPE] == self.bug_type:
-                    x_fp.append(r_bug)
-            elif true_bug_type != r_bug[BUGTYPE]:
-                x_miscls.append((true_bug_type, r_bug))
-            else:
-                x_tp.append(r_bug)
-
-        x_fn = [bug for bug in i_bugs if bug not in x_seen_ibugs]
-        fn = len(i_bugs) - len(set([str(b) for b in x_seen_ibugs]))
+        # Resolve each reported bug's injected counterpart once, then
+        # partition with boolean masks; compress materializes the lists in C
+        bug_at_line = self._line_index.get
+        own_bug_type = self.bug_type
+        hits = [bug_at_line(r_bug[LINENUM]) for r_bug in reported_bugs]
+        true_types = [i_bug and i_bug.get(BUGTYPE) for i_bug in hits]
+
+        # tp: detected the correct type; require a hit so a reported bug with a
+        # null type on an uninjected line doesn't match via None == None
+        x_tp = list(compress(reported_bugs, [t is not None and t == r[BUGTYPE] for t, r in zip(true_types, reported_bugs)]))
+        # fp: detected, but actually there is no bug
+        x_fp = list(compress(reported_bugs, [not t and r[BUGTYPE] == own_bug_type for t, r in zip(true_types, reported_bugs)]))
+        # miscls: detected, but bug type is not correct
+        x_miscls = [(t, r) for t, r in zip(true_types, reported_bugs) if t and t != r[BUGTYPE]]
+
+        # ids of found bugs with the correct type
+        seen_ids = {id(i_bug) for i_bug, t in zip(hits, true_types) if t}
+        x_fn = [bug for bug in i_bugs if id(bug) not in seen_ids]
+        fn = len(x_fn)
         tp_range = len(i_bugs) - fn
         stats = ReportStats(injected=len(i_bugs), fp=len(x_fp), tp=len(x_tp), tp_range=tp_range, miscls=len(x_miscls), fn=fn)
-        return Report(stats=stats, fp=x_fp, tp=x_tp, miscls=x_miscls, fn=x_fn, csv_path=csv_path, contract_path=contract_path_from_csv(self.csv_path))
+        return Report(stats=stats, fp=x_fp, tp=x_tp, miscls=x_miscls, fn=x_fn, csv_path=self.csv_path, contract_path=contract_path_from_csv(self.csv_path))
 
 ################################################################################
 class ToolBug():
     '''Bugs reported by testing tool. Result loaded from path'''
+    __slots__ = ()
     result_path: str
     def get_bugs(self) -> List[Dict[str, Any]]:
         ...
@@ -158,14 +167,25 @@ class ToolBug():
 ################################################################################
 class SmartFuzzBug(ToolBug):
     '''Parse Smart Fuzz bugs from a result file'''
+    __slots__ = ('result_path', 'bugs')
     def __init__(self, result_path: str):
         self.result_path = result_path
-        with open(result_path, 'r') as f:
-            data = json.loads(f.read())
-            bugs = list(data.values())
-        bugs = [replace_keys(bug, BUG_KEY_REPLACEMENT) for bug in bugs]
-        bugs = [replace_vals(bug, BUGTYPE_MAPPING) for bug in bugs]
-        bugs = sorted(bugs, key=lambda d: d[LINENUM])
+        with open(result_path, 'rb') as f:
+            data = json.load(f)
+        # Remap keys and values in a single pass instead of rebuilding each
+        # bug dict once per replacement table; bugs already using canonical
+        # keys are updated in place (safe: `data` is discarded)
+        bugs = []
+        for bug in data.values():
+            if BUG_KEY_REPLACEMENT.keys().isdisjoint(bug):
+                for k, v in bug.items():
+                    bug[k] = map_bugtype_val(v)
+            else:
+                bug = {BUG_KEY_REPLACEMENT.get(k, k): map_bugtype_val(v) for k, v in bug.items()}
+            bugs.append(bug)
+        for bug in bugs:
+            bug[LINENUM] = int(bug[LINENUM])
+        bugs = sorted(bugs, key=itemgetter(LINENUM))
         self.bugs = bugs
 
     def get_bugs(self) -> List[Dict[str, Any]]:
@@ -178,16 +198,21 @@ class SmartFuzzBug(ToolBug):
         return glob.glob(os.path.join(parent, '*.json'))
 
 ################################################################################
-def read_line(file_path: str, n: int) -> Optional[str]:
+@lru_cache(maxsize=64)
+def _load_lines(file_path: str) -> tuple:
+    '''Read a file once and cache its stripped lines'''
     with open(file_path, 'r') as f:
-        lines = f.readlines()
-        return None if len(lines) < n else lines[n-1].strip()
+        return tuple(line.strip() for line in f)
+
+def read_line(file_path: str, n: int) -> Optional[str]:
+    lines = _load_lines(file_path)
+    return lines[n-1] if 0 < n <= len(lines) else None
 
 def pretty_print_bugs(report: Report, bugs):
     for bug in bugs:
-        start = int(bug[LINENUM])
+        start = bug[LINENUM]
         if 'length' in bug:
-            end = start + int(bug["length"])
+            end = start + bug['length']
             print(f'Line {start:>2}-{end:2}')
         else:
             print(f'Line {start:>2}: {read_line(report.contract_path, start)}')
@@ -206,17 +231,31 @@ def pretty_print_report(report: Report):
         pretty_print_bugs(report, report.fp)        
     
 def print_report(report, print_raw: bool):
-    from pprint import pprint
     if print_raw:
         pprint(report)        
     else:
         pretty_print_report(report)
     
-def report_type(ibug: InjectedBug, rbug: ToolBug, print_raw: bool=False)->ReportStats:
+def report_type(ibug: InjectedBug, rbug: ToolBug, print_raw: bool=False, quiet: bool=False)->ReportStats:
     report = ibug.classify(rbug.get_bugs())
-    print_report(report, print_raw)
+    if not quiet:
+        print_report(report, print_raw)
     return report.stats
 
+def process_one(csv_path: str, report_path: Optional[str], print_raw: bool=False, quiet: bool=False):
+    '''Classify one contract; returns its stats (None if the report is missing)
+    and the text to print, so workers can run in parallel with ordered output'''
+    buf = io.StringIO()
+    with redirect_stdout(buf):
+        if report_path:
+            stats = report_type(InjectedBug(csv_path), SmartFuzzBug(report_path), print_raw=print_raw, quiet=quiet)
+        else:
+            stats = None
+            print('=' * 80)
+            contract = contract_path_from_csv(csv_path)
+            print(f'📛 missing report for {contract}')
+    return stats, buf.getvalue()
+
 ################################################################################    
         
 if __name__ == '__main__':
@@ -241,8 +280,9 @@ if __name__ == '__main__':
         print(', '.join(supported_bugs))
         sys.exit(1)
 
-    ground_truth_csvs = sorted(glob.glob(os.path.join(args.inject_contract_folder, args.bug_type, '*.csv')))
+    ground_truth_csvs = sorted(glob.glob(os.path.join(args.inject_contract_folder, args.bug_type, '*.csv')), key=idx_from_file)
     report_files = sorted(SmartFuzzBug.gen_report_file(args.tool_report_folder, args.bug_type))
+    report_by_idx = report_files_by_idx(report_files)
     summary = {
                 "Total": 0,
                 "TP": 0,
@@ -252,13 +292,26 @@ if __name__ == '__main__':
                 "FN": 0,
                 "Misclassified": 0
               }
-    for csv_path in sorted(ground_truth_csvs, key=idx_from_file):
+    pairs = []
+    for csv_path in ground_truth_csvs:
         idx = idx_from_file(csv_path)
         if args.index and args.index != idx:
             continue
-        report = report_file_by_idx(report_files, idx)
-        if report:
-            stats = report_type(InjectedBug(csv_path), SmartFuzzBug(report), print_raw=args.print_raw)
+        pairs.append((csv_path, report_by_idx.get(idx)))
+
+    # Summary-only runs don't need the per-contract report text at all
+    quiet = args.print_summary and not args.print_raw
+    worker = partial(process_one, print_raw=args.print_raw, quiet=quiet)
+    if args.index or len(pairs) <= 1:
+        # Single-contract runs aren't worth the process-spawn overhead
+        results = [worker(c, r) for c, r in pairs]
+    else:
+        with ProcessPoolExecutor() as executor:
+            results = list(executor.map(worker, *zip(*pairs)))
+
+    for stats, text in results:
+        print(text, end='')
+        if stats:
             summary["Total"] += stats.tp + stats.fp + stats.fn
             summary["Injected"] += stats.injected
             summary["TP"] += stats.tp
@@ -266,10 +319,6 @@ if __name__ == '__main__':
             summary["FN"] += stats.fn
             summary["TP_Range"] += stats.tp_range
             summary["Misclassified"] +=  stats.miscls
-        else:
-            print('=' * 80)
-            contract = contract_path_from_csv(csv_path)
-            print(f'📛 missing report for {contract}')
     if (args.print_summary):
         print ("*"*80)
         print ("Summary :")